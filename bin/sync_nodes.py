@@ -5,7 +5,7 @@
 ## Possibly can also restart systemd services via ssh.
 
 ## Requirements
-### python3
+### python3 (3.10 or newer)
 ### ssh
 ### rsync
 
@@ -39,9 +39,15 @@
 
 ## Load libraries
 
-import sys, getopt, logging, datetime, time, getpass, os
-import shutil, shlex, subprocess
+import sys, argparse, logging, logging.handlers, datetime, time, getpass, os
+import shutil, shlex, subprocess, threading, tempfile, socket, selectors
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, fields
 import yaml
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 ## Prerequisites
 
@@ -52,69 +58,91 @@ mypath = os.path.dirname(os.path.realpath(__file__))
 sys_encod = sys.getdefaultencoding()
 
 # parse script options and arguments
-try:
-    opts, args = getopt.getopt(sys.argv[1:],'hdfqc:',['help','debug','foreground','quiet','config'])
-except:
-    print('Wrong options. Abort execution.')
-    print(f'''{os.path.basename(__file__)}
-    -h | --help          print this help
-    [-d | --debug]       log verbose information
-    [-f | --foreground]  log to logfile and stdout
-    [-q | --quiet]       log only errors
-    [-c | --config]      config file path, relative to this script location''')
-    exit(1)
+parser = argparse.ArgumentParser(description='Sync folders and files between nodes with rsync via ssh.')
+parser.add_argument('-d', '--debug', action='store_true', help='log verbose information')
+parser.add_argument('-f', '--foreground', action='store_true', help='log to logfile and stdout')
+parser.add_argument('-q', '--quiet', action='store_true', help='log only errors')
+parser.add_argument('-c', '--config', default='../conf/settings.yaml', help='config file path, relative to this script location')
+args = parser.parse_args()
 
 # default settings
-log_level = "INFO"
-debug = foreground = quiet = False
-setting_file = f'{mypath}/../conf/settings.yaml'
-
-for (opt, arg) in opts:
-    if (opt == '-d') or (opt == '--debug'):
-        log_level = "DEBUG"
-        debug = True
-    if (opt == '-f') or (opt == '--foreground'):
-        foreground = True
-    if (opt == '-q') or (opt == '--quiet'):
-        log_level = "ERROR"
-        quiet = True
-    if (opt == '-c') or (opt == '--config'):
-        setting_file = f'{mypath}/{arg}'
-    if (opt == '-h') or (opt == '--help'):
-        print(f'''{os.path.basename(__file__)}
-    -h | --help          print this help
-    [-d | --debug]       log verbose information
-    [-f | --foreground]  log to logfile and stdout
-    [-q | --quiet]       log only errors
-    [-c | --config]      config file path, relative to this script location''')
-        exit(0)
-
-# manage log and stdout
-def mylog(debug, foreground, quiet, level, message):
-    if not foreground:
-        if level == "info":
-            logging.info(message)
-        elif level == "error":
-            logging.error(message)
-        else:
-            logging.debug(message)
-    else:
-        if level == "info":
-            logging.info(message)
-            if not quiet:
-                print(message)
-        elif level == "error":
-            logging.error(message)
-            print(message)
-        else:
-            logging.debug(message)
-            if debug:
-                print(message)
+debug, foreground, quiet = args.debug, args.foreground, args.quiet
+if quiet:
+    log_level = "ERROR"
+elif debug:
+    log_level = "DEBUG"
+else:
+    log_level = "INFO"
+setting_file = f'{mypath}/{args.config}'
+
+# serialize stdout between node threads
+print_lock = threading.Lock()
+
+def locked_print(message):
+    with print_lock:
+        print(message)
+
+# manage log and stdout - log functions are chosen once, based on script options
+def log_and_print(log):
+    def log_message(message):
+        log(message)
+        locked_print(message)
+    return log_message
+
+log_info = log_and_print(logging.info) if foreground and not quiet else logging.info
+log_debug = log_and_print(logging.debug) if foreground and debug else logging.debug
+log_error = log_and_print(logging.error) if foreground else logging.error
+
+# log formatter - records logged in the same second reuse the formatted time
+class CachedTimeFormatter(logging.Formatter):
+    def __init__(self, fmt, datefmt):
+        super().__init__(fmt, datefmt)
+        self.cached_second = None
+        self.cached_time = None
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        if second != self.cached_second:
+            self.cached_time = time.strftime(self.datefmt, time.localtime(second))
+            self.cached_second = second
+        return self.cached_time
+
+# settings of nodes, folders and services - optional options get their default here
+@dataclass(slots=True)
+class Node:
+    address: str
+    folders: list
+    ssh_port: int = 22
+    user: str = field(default_factory=getpass.getuser)
+
+@dataclass(slots=True)
+class Folder:
+    path: str
+    dest: str | None = None
+    rsync_options: str | None = None
+    rsync_batch: bool = False
+    # rsync_options split into arguments
+    rsync_args: list = field(init=False)
+
+    def __post_init__(self):
+        if self.dest is None:
+            self.dest = self.path
+        self.rsync_args = shlex.split(self.rsync_options or "")
+
+@dataclass(slots=True)
+class Service:
+    name: str
+    method: str
+    sudo: bool = False
+
+# build a settings object - yaml keys use '-' where attributes use '_'
+def from_settings(cls, settings):
+    return cls(**{key.replace('-', '_'): value for key, value in settings.items()})
 
 # load settings from file
 if os.path.isfile(setting_file):
     with open(setting_file, "r") as f:
-        config = yaml.safe_load(f)
+        config = yaml.load(f, Loader=YamlLoader)
 else:
     print('Settings file not present. Abort execution')
     exit(1)
@@ -126,117 +154,298 @@ if config is None:
 if "log_file" not in config or config["log_file"] == '':
     config["log_file"] = "sync_nodes.log"
 log_file_name = f'{mypath}/../log/{datetime.datetime.today().strftime("%Y%m")}-{config["log_file"]}'
-logging.basicConfig(filename = log_file_name, level = log_level, format = '%(asctime)s %(message)s', datefmt = '%Y%m%d-%H%M%S')
-
-mylog(debug, foreground, quiet, 'info', '--------')
-mylog(debug, foreground, quiet, 'debug', 'Settings file loaded')
+log_handler = logging.FileHandler(log_file_name)
+log_handler.setFormatter(CachedTimeFormatter('%(asctime)s %(message)s', '%Y%m%d-%H%M%S'))
+# buffer log records - written when an error is logged, when the buffer is full and at exit
+log_buffer = logging.handlers.MemoryHandler(capacity=1024, flushLevel=logging.ERROR, target=log_handler)
+logging.getLogger().addHandler(log_buffer)
+logging.getLogger().setLevel(log_level)
+# rsync statistics are logged only when debug records reach the log file
+rsync_stats = log_level == "DEBUG"
+
+log_info('--------')
+log_debug('Settings file loaded')
 
 # sleep settings
 if "sleep-time-folders" not in config or config["sleep-time-folders"] == '':
-    config["sleep-time-folders"] = 1
+    config["sleep-time-folders"] = 0
 if "sleep-time-services" not in config or config["sleep-time-services"] == '':
-    config["sleep-time-services"] = 1
+    config["sleep-time-services"] = 0
+
+# parallel settings
+if "max-parallel-nodes" not in config or config["max-parallel-nodes"] == '':
+    config["max-parallel-nodes"] = 8
+if "max-parallel-folders" not in config or config["max-parallel-folders"] == '':
+    config["max-parallel-folders"] = 4
+
+# reachability settings
+if "probe-timeout" not in config or config["probe-timeout"] == '':
+    config["probe-timeout"] = 2
 
 # needed binaries
-mylog(debug, foreground, quiet, 'debug', 'Looking for binaries path')
-bin_path = {
-    'ssh' : shutil.which("ssh"),
-    'rsync' : shutil.which("rsync")
-}
+log_debug('Looking for binaries path')
+# use the paths from settings when given, to skip the PATH lookup
+bin_path = {key: config.get(f'{key}-binary') or shutil.which(key) for key in ('ssh', 'rsync')}
 for key, value in bin_path.items():
-    if value is None:
-        mylog(debug, foreground, quiet, 'error', f'{key} binary not found. Abort execution\n')
+    if value is None or not os.access(value, os.X_OK):
+        log_error(f'{key} binary not found. Abort execution\n')
         exit(1)
 
+# ssh options - every ssh and rsync of a node reuses one master connection
+run_path = os.path.realpath(f'{mypath}/../run')
+os.makedirs(run_path, exist_ok=True)
+ssh_options = ['-o', 'ControlMaster=auto', '-o', f'ControlPath={run_path}/cm-%C', '-o', 'ControlPersist=120s', '-o', 'BatchMode=yes']
+
 ## Code execution - script starts here
 
-mylog(debug, foreground, quiet, 'info', 'Start execution')
+log_info('Start execution')
 
 # exit if no nodes present
 if config["nodes"] is None:
-    mylog(debug, foreground, quiet, 'info', 'Config file has not nodes. Exit\n')
+    log_info('Config file has not nodes. Exit\n')
     exit(0)
 
-mylog(debug, foreground, quiet, 'debug', f'Loaded {len(config["nodes"])} nodes')
-mylog(debug, foreground, quiet, 'debug', f'Loaded {len(config["folders"])} folders')
-if config["enable-services"]:
-    mylog(debug, foreground, quiet, 'debug', f'Loaded {len(config["services"])} services')
-
-# start loop for nodes
-for id_n, node in config["nodes"].items():
-    # manage optional options
-    if not "ssh-port" in node:
-        node["ssh-port"] = 22
-    if not "user" in node:
-        node["user"] = getpass.getuser()
-
-    mylog(debug, foreground, quiet, 'info', f'Connecting to {node["address"]}:{node["ssh-port"]} ...')
-    # check if connection with shared keys is working
-    command = shlex.split(f'{bin_path["ssh"]} -o BatchMode=yes -p {node["ssh-port"]} {node["user"]}@{node["address"]} "ls /dev/null > /dev/null"')
+if debug:
+    log_debug(f'Loaded {len(config["nodes"])} nodes')
+    log_debug(f'Loaded {len(config["folders"])} folders')
+    if config["enable-services"]:
+        log_debug(f'Loaded {len(config["services"] or {})} services')
+
+# a folder can share rsync with others if it is synced to the same absolute path without extra options
+def can_share_rsync(folder):
+    if folder.rsync_args or folder.rsync_batch or folder.dest != folder.path or not folder.path.startswith('/'):
+        return False
+    # without trailing slash a directory would be synced inside dest, not onto it
+    return folder.path.endswith('/') or os.path.isfile(folder.path)
+
+# start rsync of a group of folders to a node
+def start_rsync(id_n, rsync_prefix, batch_prefix, address, group):
+    ids = [id_f for id_f, folder in group]
+    from_batch = len(group) == 1 and group[0][0] in batch_files
+    if from_batch:
+        id_f, folder = group[0]
+        log_info(f'{id_n}: Syncing {id_f} folder from batch ...')
+        # applying the batch with the remote rsync, reading it from stdin
+        # receiver options are not stored in the batch, so the folder options are given again
+        command = batch_prefix + [shlex.join(['rsync', '--read-batch=-', '-a'] + folder.rsync_args + [folder.dest])]
+        stdin = open(batch_files[id_f], 'rb')
+    elif len(group) == 1:
+        id_f, folder = group[0]
+        log_info(f'{id_n}: Syncing {id_f} folder ...')
+        # executing rsync command
+        command = rsync_prefix + folder.rsync_args + [folder.path, f'{address}:{folder.dest}']
+        stdin = subprocess.DEVNULL
+    else:
+        log_info(f'{id_n}: Syncing {" ".join(map(str, ids))} folders together ...')
+        # executing a single rsync command, reading the folder paths relative to / from stdin
+        command = rsync_prefix + ['-r', '--no-implied-dirs', '--files-from=-', '/', f'{address}:/']
+        stdin = tempfile.TemporaryFile('w+', encoding=sys_encod)
+        stdin.writelines(f'{folder.path[1:]}\n' for id_f, folder in group)
+        stdin.seek(0)
+    # statistics are kept in a file per rsync, to be logged in one block when it ends - batches print none
+    stats = tempfile.TemporaryFile() if rsync_stats and not from_batch else subprocess.DEVNULL
+    proc = subprocess.Popen(command, stdin=stdin, stdout=stats, stderr=subprocess.PIPE)
+    if stdin is not subprocess.DEVNULL:
+        stdin.close()
+    return group, proc, [], stats
+
+# wait for the first rsync to finish and log its result - return the folders to sync again one by one
+def wait_rsync(id_n, pending):
+    # read the errors of every running rsync until one closes its stderr, so no pipe fills up
+    finished = None
+    with selectors.DefaultSelector() as selector:
+        for job in pending:
+            selector.register(job[1].stderr, selectors.EVENT_READ, job)
+        while finished is None:
+            for key, _ in selector.select():
+                data = os.read(key.fd, 65536)
+                if data:
+                    key.data[2].append(data)
+                else:
+                    finished = key.data
+                    break
+    pending.remove(finished)
+    group, proc, errors, stats = finished
+    ids = [id_f for id_f, folder in group]
+    proc.stderr.close()
+    proc.wait()
+    if stats is not subprocess.DEVNULL:
+        stats.seek(0)
+        log_debug(f'{id_n}: rsync statistics of {" ".join(map(str, ids))}:\n{stats.read().decode(sys_encod)}')
+        stats.close()
+    output = b''.join(errors).decode(sys_encod)
+    if proc.returncode != 0 and len(group) > 1:
+        # a shared rsync does not tell which folder failed
+        log_error(f'{id_n}: rsync output:\n{output}')
+        log_error(f'{id_n}: Shared rsync of {" ".join(map(str, ids))} folders failed, syncing them one by one')
+        return [[(id_f, folder)] for id_f, folder in group]
+    if proc.returncode != 0:
+        log_error(f'{id_n}: rsync output:\n{output}')
+        log_error(f'{id_n}: Skipped folder {ids[0]}')
+    else:
+        for id_f in ids:
+            log_info(f'{id_n}: {id_f} successfully synced')
+    return []
+
+# sync all folders of a node, at most max-parallel-folders rsync at a time
+def sync_folders(id_n, rsync_prefix, batch_prefix, address, folders, config):
+    # folders that can share rsync are synced together, saving a connection and a file list each
+    shared = [(id_f, folder) for id_f, folder in folders if can_share_rsync(folder)]
+    if len(shared) > 1:
+        groups = [shared] + [[(id_f, folder)] for id_f, folder in folders if not can_share_rsync(folder)]
+    else:
+        groups = [[(id_f, folder)] for id_f, folder in folders]
+
+    pending = []
+    while groups or pending:
+        if groups and len(pending) < config["max-parallel-folders"]:
+            pending.append(start_rsync(id_n, rsync_prefix, batch_prefix, address, groups.pop(0)))
+            # sleep between folders start - if enabled
+            if config["sleep-time-folders"] and groups:
+                time.sleep(config["sleep-time-folders"])
+        else:
+            groups += wait_rsync(id_n, pending)
+
+# sync a single node, logging unexpected errors so that other nodes and the end of execution go on
+def sync_node_safely(id_n, node, config, bin_path):
     try:
-        conn_check = subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
-    except:
-        mylog(debug, foreground, quiet, 'error', f'... Connection failed. Skipping node {id_n}')
-        continue
+        sync_one_node(id_n, node, config, bin_path)
+    except Exception as e:
+        log_error(f'{id_n}: Unexpected error: {e!r}. Skipping node {id_n}')
 
-    if not isinstance(node["folders"], list) or node["folders"] == "all" :
-        node["folders"] = list(config["folders"].keys())
-    elif isinstance(node["folders"], list):
+# check if the ssh port of a node accepts connections
+def port_open(node, timeout):
+    try:
+        with socket.create_connection((node.address, node.ssh_port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+# sync folders and services of a single node
+def sync_one_node(id_n, node, config, bin_path):
+    if not isinstance(node.folders, list) or node.folders == "all" :
+        node.folders = list(config["folders"].keys())
+    elif isinstance(node.folders, list):
         pass
     else:
-        mylog(debug, foreground, quiet, 'error', f'Wrong folders configuration. Skipping node {id_n}')
-        continue
-
-    # start loop for folders
-    for id_f, folder in config["folders"].items():
-        if id_f in node["folders"]:
-            # manage optional options
-            if not "rsync-options" in folder or folder["rsync-options"] is None:
-                folder["rsync-options"] = ""
-            if not "dest" in folder:
-                folder["dest"] = folder["path"]
-
-            mylog(debug, foreground, quiet, 'info', f'Syncing {id_f} folder ...')
-            # executing rsync command
-            command = shlex.split(f'{bin_path["rsync"]} -a -v -e "ssh -o BatchMode=yes -l {node["user"]} -p {node["ssh-port"]}" {folder["rsync-options"]} {folder["path"]} {node["address"]}:{folder["dest"]}')
-            try:
-                rsync_folder = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding=sys_encod)
-            except subprocess.CalledProcessError as e:
-                mylog(debug, foreground, quiet, 'error', f'rsync output:\n{e.output}')
-                mylog(debug, foreground, quiet, 'error', f'Skipped folder {id_f}')
-                continue
-            else:
-                mylog(debug, foreground, quiet, 'debug', f'rsync output:\n{rsync_folder.stdout}')
-                mylog(debug, foreground, quiet, 'info', f'{id_f} successfully synced')
-
-            # sleep between folders
-            time.sleep(config["sleep-time-folders"])
-
-    # start loop for services - if enabled
-    if config["enable-services"]:
+        log_error(f'{id_n}: Wrong folders configuration. Skipping node {id_n}')
+        return
+
+    # command prefixes, the same for every folder and service of the node
+    ssh_prefix = [bin_path["ssh"]] + ssh_options + ['-p', str(node.ssh_port)]
+    remote = f'{node.user}@{node.address}'
+    # rsync prints transfer statistics only in debug mode, otherwise keeps just errors
+    rsync_prefix = [bin_path["rsync"], '-a'] + (['--info=stats2'] if rsync_stats else []) + ['-e', shlex.join(ssh_prefix + ['-l', node.user])]
+    batch_prefix = ssh_prefix + [remote]
+
+    log_info(f'{id_n}: Connecting to {node.address}:{node.ssh_port} ...')
+    # check if connection with shared keys is working - it also starts the shared master connection
+    command = ssh_prefix + [remote, 'true']
+    try:
+        conn_check = subprocess.run(command, check=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    except:
+        log_error(f'{id_n}: ... Connection failed. Skipping node {id_n}')
+        return
+
+    # sync folders in parallel
+    node_folders = frozenset(node.folders)
+    folders = [(id_f, folder) for id_f, folder in config["folders"].items() if id_f in node_folders]
+    sync_folders(id_n, rsync_prefix, batch_prefix, node.address, folders, config)
+
+    # restart|reload services with a single ssh - if enabled and any service is set
+    if config["enable-services"] and config["services"]:
+        methods = []
+        checks = []
         for id_s, service in config["services"].items():
-
-            mylog(debug, foreground, quiet, 'info', f'Trying service {id_s} {service["method"]} ...')
-            
-            # manage optional options
-            if not "sudo" in service:
-                service["sudo"] = False
-            
-            # restarting|reloading services
-            command = shlex.split(f'{bin_path["ssh"]} -q -t -o BatchMode=yes -p {node["ssh-port"]} {node["user"]}@{node["address"]} "{"sudo" if service["sudo"] else ""} systemctl {service["method"]} {service["name"]}; sleep 2; {"sudo" if service["sudo"] else ""} systemctl is-active {service["name"]}"')
-            try:
-                re_service = subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding=sys_encod)
-            except subprocess.CalledProcessError as e:
-                mylog(debug, foreground, quiet, 'debug', f'command output:\n{e.output}')
-                mylog(debug, foreground, quiet, 'error', f'... something went wrong. Please check on {id_n} system')
-                continue
+            log_info(f'{id_n}: Trying service {id_s} {service.method} ...')
+            sudo = "sudo " if service.sudo else ""
+            methods.append(f'{sudo}systemctl {service.method} {service.name}')
+            # print a marker with the exit code of each check, to be parsed below - yaml ids may be numbers
+            checks.append(f'{sudo}systemctl is-active {service.name}; echo ::marker::{shlex.quote(str(id_s))}::$?')
+        # sleep between services - if enabled
+        separator = f'; sleep {config["sleep-time-services"]}; ' if config["sleep-time-services"] else '; '
+        remote_script = separator.join(methods) + '; sleep 2; ' + '; '.join(checks)
+
+        # no tty and no stdin - parallel nodes must not share the terminal
+        command = ssh_prefix + ['-q', remote, remote_script]
+        re_services = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, encoding=sys_encod)
+        if debug:
+            log_debug(f'{id_n}: command output:\n{re_services.stdout}')
+        exit_codes = {}
+        for line in re_services.stdout.splitlines():
+            line = line.strip()
+            if line.startswith('::marker::'):
+                id_s, code = line[len('::marker::'):].rsplit('::', 1)
+                exit_codes[id_s] = code
+        for id_s, service in config["services"].items():
+            if exit_codes.get(str(id_s)) == '0':
+                log_info(f'{id_n}: {id_s} successfully {service.method}ed')
             else:
-                mylog(debug, foreground, quiet, 'debug', f'command output:\n{re_service.stdout}')
-                mylog(debug, foreground, quiet, 'info', f'{id_s} successfully {service["method"]}ed')
+                log_error(f'{id_n}: ... {id_s} {service.method} failed. Please check on {id_n} system')
+
+    # stop the shared master connection - sessions still running on it, maybe of another node entry with the same host, can end
+    command = ssh_prefix + ['-O', 'stop', remote]
+    subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+# load nodes, folders and services settings once, before nodes run in parallel
+def load_settings(section, name, cls):
+    options = {option.name for option in fields(cls) if option.init}
+    objects = {}
+    for id_x, settings in (config[section] or {}).items():
+        try:
+            # unknown options are ignored
+            for key in [key for key in settings if key.replace('-', '_') not in options]:
+                log_error(f'Unknown option {key} of {name} {id_x} ignored')
+                del settings[key]
+            objects[id_x] = from_settings(cls, settings)
+        except (TypeError, AttributeError) as e:
+            log_error(f'Settings of {name} {id_x} wrongly formatted: {e}. Abort execution\n')
+            exit(1)
+    return objects
+
+config["nodes"] = load_settings("nodes", "node", Node)
+config["folders"] = load_settings("folders", "folder", Folder)
+if config["enable-services"]:
+    config["services"] = load_settings("services", "service", Service)
+
+# skip nodes whose ssh port does not answer, probing all of them at once - if enabled
+nodes = config["nodes"]
+if config["probe-timeout"]:
+    with ThreadPoolExecutor(max_workers=64) as executor:
+        reachable = dict(zip(nodes, executor.map(lambda node: port_open(node, config["probe-timeout"]), nodes.values())))
+    for id_n, node in config["nodes"].items():
+        if not reachable[id_n]:
+            log_error(f'{id_n}: {node.address}:{node.ssh_port} not reachable. Skipping node {id_n}')
+    nodes = {id_n: node for id_n, node in config["nodes"].items() if reachable[id_n]}
+
+# write rsync batches once, to be applied on every node - if enabled
+batch_files = {}
+batch_folders = [(id_f, folder) for id_f, folder in config["folders"].items() if folder.rsync_batch]
+if batch_folders:
+    batch_dir = tempfile.TemporaryDirectory(dir=run_path)
+    # batches are written against an empty destination, so they hold the whole content of the folders
+    empty_dir = f'{batch_dir.name}/empty/'
+    os.mkdir(empty_dir)
+    for i, (id_f, folder) in enumerate(batch_folders):
+        # a batch written against an empty destination holds no deletions
+        if any(option == '--del' or option.startswith('--delete') for option in folder.rsync_args):
+            log_error(f'Batch of folder {id_f} cannot delete files on nodes, syncing it without batch')
+            continue
+        batch_file = f'{batch_dir.name}/batch-{i}'
+        command = [bin_path["rsync"], '-a', f'--only-write-batch={batch_file}'] + folder.rsync_args + [folder.path, empty_dir]
+        write_batch = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding=sys_encod)
+        if write_batch.returncode != 0:
+            log_error(f'rsync output:\n{write_batch.stderr}')
+            log_error(f'Batch of folder {id_f} not written, syncing it without batch')
+        else:
+            batch_files[id_f] = batch_file
 
-            # sleep between services
-            time.sleep(config["sleep-time-services"])
+# sync nodes in parallel - rsync and ssh are network bound, so threads are enough
+with ThreadPoolExecutor(max_workers=config["max-parallel-nodes"]) as executor:
+    list(executor.map(lambda item: sync_node_safely(*item, config, bin_path), nodes.items()))
 
+if batch_folders:
+    batch_dir.cleanup()
 
-mylog(debug, foreground, quiet, 'info', 'End execution\n')
+log_info('End execution\n')
 exit(0)